@@ -46,6 +46,7 @@ if has('win32') || has('win64')
 else
     let s:path_sep = '/'
 endif
+let s:refresh_timers = {}
 " }}}
 
 " functions {{{
@@ -138,6 +139,18 @@ function! s:EnterPressedGrep()
     endif
     let ln = getpos('.')[1]
     if ln > 1
+        " match location is known when grep output was read as json
+        let loc = pyxeval('asyncfinder.AsyncGrepLocation()')
+        if len(loc) > 0 && filereadable(loc[0])
+            if g:asyncfinder_grep_open_in_prev_win
+                exe b:prevwinnr.'wincmd w'
+            else
+                silent! bd!
+            endif
+            exe ':e +'.loc[1].' '.fnameescape(loc[0])
+            call cursor(loc[1],loc[2])
+            return
+        endif
         let line = getline(ln)
         let mln = matchstr(line, ":\\d\\+:")
         if mln != ''
@@ -212,6 +225,9 @@ function! s:ChangeMode()
     endif
     call setbufvar('%','asyncfinder_mode',mode)
     pythonx asyncfinder.AsyncCancel()
+    if has('timers')
+        call s:StartRefresh('AsyncRefreshT')
+    endif
 endfunction
 function! s:ChangeModeTo(mode)
     if a:mode == 'a' || a:mode == 'b' || a:mode == 'f' || a:mode =='m' 
@@ -219,6 +235,22 @@ function! s:ChangeModeTo(mode)
         call setbufvar('%','asyncfinder_mode',a:mode)
     endif
 endfunction
+function! s:StartRefresh(refresh)
+    let name = bufname('%')
+    if get(s:refresh_timers,name,-1) == -1
+        let s:refresh_timers[name] = timer_start(0,function('s:RefreshTimer',[name,a:refresh]))
+    endif
+endfunction
+function! s:RefreshTimer(name,refresh,timer)
+    let s:refresh_timers[a:name] = -1
+    " stop refreshing when window is left, BufEnter starts it again
+    if bufname('%') !=# a:name
+        return
+    endif
+    if pyxeval('asyncfinder.'.a:refresh.'()')
+        let s:refresh_timers[a:name] = timer_start(g:asyncfinder_refresh_interval,function('s:RefreshTimer',[a:name,a:refresh]))
+    endif
+endfunction
 function! s:SetStatus(status)
     let &l:statusline=a:status
 endfunction
@@ -258,6 +290,19 @@ function! s:GrepCmd()
         endfor
         let pattern = substitute(s:GrepPattern(),"'","'\"'\"'",'g')
         return g:asyncfinder_grep_cmd.options.' '''.pattern.''' '.getcwd()
+    elseif s:StrEndsWith(g:asyncfinder_grep_cmd,'rg')
+        " rg command, output is read as json to get match columns
+        if !g:asyncfinder_grep_ignore_case
+            let options .= ' -s'
+        endif
+        for f in eval(g:asyncfinder_grep_ignore_files)
+            let options .= ' --glob ''!'.f.''''
+        endfor
+        for d in eval(g:asyncfinder_grep_ignore_dirs)
+            let options .= ' --glob ''!'.d.''''
+        endfor
+        let pattern = substitute(s:GrepPattern(),"'","'\"'\"'",'g')
+        return g:asyncfinder_grep_cmd.' --json'.options.' -e '''.pattern.''' '.getcwd()
     else
         " grep command
         for f in eval(g:asyncfinder_grep_ignore_files)
@@ -286,17 +331,21 @@ function! asyncfinder#OpenWindow(bang,win,pattern)
         execute a:win.(&lines/3).'sp asyncfinder'
         setlocal filetype=asyncfinder buftype=nofile bufhidden=wipe nolist nobuflisted noswapfile nonumber nowrap
         call setbufvar("%","prevwinnr",winnr('#'))
-        call setbufvar("%","prevupdatetime",&updatetime)
         call setbufvar("%","asyncfinder_mode",g:asyncfinder_initial_mode)
         call s:SetStatus('Type your pattern (mode: '.g:asyncfinder_initial_mode.' cwd: '.getcwd().')')
         call s:ClearPrompt()
-        set updatetime=250
-        au BufEnter <buffer> set updatetime=250
         au BufWipeout <buffer> pythonx asyncfinder.AsyncCancel()
-        au BufLeave <buffer> let &updatetime=getbufvar('%','prevupdatetime')
         au InsertEnter <buffer> call s:PositionCursor()
-        au CursorHold <buffer> pythonx asyncfinder.AsyncRefreshN()
-        au CursorHoldI <buffer> pythonx asyncfinder.AsyncRefreshI()
+        if has('timers')
+            au BufEnter,TextChanged,TextChangedI <buffer> call s:StartRefresh('AsyncRefreshT')
+        else
+            call setbufvar("%","prevupdatetime",&updatetime)
+            set updatetime=250
+            au BufEnter <buffer> set updatetime=250
+            au BufLeave <buffer> let &updatetime=getbufvar('%','prevupdatetime')
+            au CursorHold <buffer> pythonx asyncfinder.AsyncRefreshN()
+            au CursorHoldI <buffer> pythonx asyncfinder.AsyncRefreshI()
+        endif
         au InsertCharPre <buffer> call <SID>CharTyped()
         inoremap <buffer> <CR> <ESC>:call <SID>EnterPressedI()<CR>
         inoremap <buffer> <BS> <ESC>:call <SID>BackspacePressed() \| startinsert<CR>
@@ -358,7 +407,6 @@ function! asyncfinder#OpenGrepWindow(bang,win,pattern)
         execute a:win.(&lines/3).'sp asyncgrep'
         setlocal filetype=asyncgrep buftype=nofile bufhidden=wipe nolist nobuflisted noswapfile nonumber nowrap
         call setbufvar("%","prevwinnr",winnr('#'))
-        call setbufvar("%","prevupdatetime",&updatetime)
         if g:asyncfinder_grep_cmd == 'builtin'
             let s = 'ignore_files: '.g:asyncfinder_grep_ignore_files
             let s .= ' ignore_dirs: '.g:asyncfinder_grep_ignore_dirs
@@ -371,13 +419,18 @@ function! asyncfinder#OpenGrepWindow(bang,win,pattern)
             call s:SetStatus('Type your pattern ('.s:GrepCmd().')')
         endif
         call s:ClearPrompt()
-        set updatetime=250
-        au BufEnter <buffer> set updatetime=250
         au BufWipeout <buffer> pythonx asyncfinder.AsyncGrepCancel()
-        au BufLeave <buffer> let &updatetime=getbufvar('%','prevupdatetime')
         au InsertEnter <buffer> call s:PositionCursor()
-        au CursorHold <buffer> pythonx asyncfinder.AsyncGrepRefreshN()
-        au CursorHoldI <buffer> pythonx asyncfinder.AsyncGrepRefreshI()
+        if has('timers')
+            au BufEnter,TextChanged,TextChangedI <buffer> call s:StartRefresh('AsyncGrepRefreshT')
+        else
+            call setbufvar("%","prevupdatetime",&updatetime)
+            set updatetime=250
+            au BufEnter <buffer> set updatetime=250
+            au BufLeave <buffer> let &updatetime=getbufvar('%','prevupdatetime')
+            au CursorHold <buffer> pythonx asyncfinder.AsyncGrepRefreshN()
+            au CursorHoldI <buffer> pythonx asyncfinder.AsyncGrepRefreshI()
+        endif
         au InsertCharPre <buffer> call <SID>CharTyped()
         inoremap <buffer> <CR> <ESC>:call <SID>EnterPressedGrepI()<CR>
         inoremap <buffer> <BS> <ESC>:call <SID>BackspacePressed() \| startinsert<CR>
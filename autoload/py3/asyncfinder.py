@@ -7,56 +7,358 @@
 # License: Vim License (see :help license)
 # Website: https://github.com/troydm/asyncfinder.vim
 
-import vim, os, threading, multiprocessing, queue, fnmatch, re, random, platform, subprocess, time
+import vim, os, threading, multiprocessing, queue, fnmatch, re, random, platform, subprocess, time, hashlib, zlib, heapq, collections, mmap, array, io, signal, json, base64, traceback
+import pickle
+
+try:
+    import re._parser as sre_parse
+except ImportError:
+    import sre_parse
 
 try:
     import fcntl, select
 except Error:
     pass
 
+try:
+    import selectors
+except ImportError:
+    selectors = None
+
 async_pattern = None
 async_grep_pattern = None
 async_prev_pattern = None
 async_grep_prev_pattern = None
 async_prev_mode = None
 async_output = None
+async_glob = None
 async_grep_output = None
-async_grep_file_output = None
 async_on_windows = platform.system() == 'Windows'
+async_scandir = getattr(os,'scandir',None)
+async_match_pool = None
+async_match_cache = {}
+async_refine_matches = 100000
+async_grep_max_pending = 50000
+async_hidden_size = 16*1024*1024
+async_grep_sniff_size = 8192
+async_grep_window_size = 1024*1024
+async_grep_cache_size = 32*1024*1024
+async_grep_refine_lines = 100000
+async_grep_results = None
+async_grep_locations = {}
+async_indexes = {}
+async_grep_indexes = {}
+async_grep_index_max_size = 1024*1024
+async_grep_index_word = re.compile(b'[a-z0-9_]{3,}')
+async_git_files = {}
+async_index_refresh_interval = 1.0
+
+def AsyncEncode(s):
+    return s.encode('utf-8')
+
+def AsyncDecode(b):
+    return b.decode('utf-8','ignore')
+
+def AsyncText(s):
+    return s
+
+def AsyncCompile(patterns,case_sensitive=False):
+    # translate list of glob patterns into single regular expression
+    if len(patterns) == 0:
+        return lambda f: None
+    flags = re.S
+    if not case_sensitive:
+        flags |= re.I
+    regex = []
+    for p in patterns:
+        r = fnmatch.translate(p)
+        if r.endswith('(?ms)'):
+            r = r[:-5]
+        regex.append('(?:'+r+')')
+    return re.compile('|'.join(regex),flags).match
 
 class AsyncOutput:
+    # producers publish whole batches and consumer takes all of them at
+    # once, deque append and popleft are atomic so no lock is needed
     def __init__(self):
-        self.lock = threading.Lock()
-        self.output = []
-        self.toexit = False
+        self.batches = collections.deque()
+        self.toexit = threading.Event()
     
     def get(self):
-        self.lock.acquire()
-        r = self.output
-        self.output = []
-        self.lock.release()
+        r = []
+        try:
+            while True:
+                r.extend(self.batches.popleft())
+        except IndexError:
+            pass
         return r
 
     def append(self,data):
-        self.lock.acquire()
-        self.output.append(data)
-        self.lock.release()
+        self.batches.append([data])
 
     def extend(self,data):
+        # data shouldn't be modified after it's published
+        if len(data) > 0:
+            self.batches.append(data)
+
+    def exit(self):
+        self.toexit.set()
+    
+    def toExit(self): 
+        return self.toexit.is_set()
+
+class AsyncBoundedOutput(AsyncOutput):
+    # producer waits while more than limit lines are waiting to be taken,
+    # tasks in worker pool publish without waiting so they never block it
+    def __init__(self,limit):
+        AsyncOutput.__init__(self)
+        self.limit = limit
+        self.size = 0
+        self.cond = threading.Condition()
+
+    def get(self):
+        r = AsyncOutput.get(self)
+        if len(r) > 0:
+            self.cond.acquire()
+            self.size -= len(r)
+            self.cond.notify_all()
+            self.cond.release()
+        return r
+
+    def append(self,data):
+        self.extend([data])
+
+    def extend(self,data):
+        if len(data) == 0:
+            return
+        self.cond.acquire()
+        self.size += len(data)
+        self.cond.release()
+        AsyncOutput.extend(self,data)
+
+    def wait(self):
+        self.cond.acquire()
+        while self.size >= self.limit and not self.toExit():
+            self.cond.wait(0.05)
+        self.cond.release()
+
+class AsyncRankedOutput(AsyncOutput):
+    # keeps only limit best scored results in a heap, most recently used
+    # files that are already listed as files are skipped
+    def __init__(self,query,limit):
+        AsyncOutput.__init__(self)
+        self.lock = threading.Lock()
+        self.query = query.lower()
+        self.limit = limit
+        self.heap = []
+        self.lines = set()
+        self.seq = 0
+        self.changed = False
+
+    def get(self):
         self.lock.acquire()
-        self.output.extend(data)
+        r = None
+        if self.changed:
+            self.changed = False
+            r = [d for (score,seq,d) in sorted(self.heap,reverse=True)]
         self.lock.release()
+        return r
 
-    def exit(self):
+    def append(self,data):
+        score = AsyncScore(self.query,data[2:])
+        if score == None:
+            return
         self.lock.acquire()
-        self.toexit = True
+        # same path listed before has same score and is never worse so
+        # it's either still in the heap or this one isn't added either
+        if data.startswith('m ') and ('f'+data[1:] in self.lines or 'd'+data[1:] in self.lines):
+            self.lock.release()
+            return
+        self.seq += 1
+        item = (score,-self.seq,data)
+        if len(self.heap) < self.limit:
+            heapq.heappush(self.heap,item)
+            self.lines.add(data)
+            self.changed = True
+        elif item > self.heap[0]:
+            self.lines.discard(heapq.heapreplace(self.heap,item)[2])
+            self.lines.add(data)
+            self.changed = True
         self.lock.release()
-    
-    def toExit(self): 
+
+    def extend(self,data):
+        for d in data:
+            self.append(d)
+
+class AsyncRenderer:
+    # appends output to buffer in limited batches, lines over max_lines
+    # stay in memory instead of being appended until they take more than
+    # async_hidden_size bytes, after that they are only counted
+    def __init__(self):
+        self.pending = []
+        self.shown = 0
+        self.hidden = []
+        self.hidden_size = 0
+        self.dropped = 0
+
+    def reset(self):
+        self.pending = []
+        self.shown = 0
+        self.hidden = []
+        self.hidden_size = 0
+        self.dropped = 0
+
+    def render(self,output,max_lines,batch_lines):
+        # returns number of lines that aren't shown because of max_lines
+        if output != None:
+            self.pending.extend(output.get())
+        over = self.shown+len(self.pending)-max_lines
+        if over > 0:
+            if self.hidden_size >= async_hidden_size:
+                self.dropped += over
+            else:
+                for l in self.pending[len(self.pending)-over:]:
+                    if self.hidden_size >= async_hidden_size:
+                        self.dropped += 1
+                    else:
+                        self.hidden.append(l)
+                        self.hidden_size += len(l)
+            del self.pending[len(self.pending)-over:]
+        n = min(len(self.pending),batch_lines)
+        if n > 0:
+            vim.current.buffer.append(self.pending[:n])
+            del self.pending[:n]
+            self.shown += n
+        return len(self.hidden)+self.dropped
+
+async_renderer = AsyncRenderer()
+async_grep_renderer = AsyncRenderer()
+
+class AsyncThreadPool:
+    # threads live for the whole vim session and run tasks from shared queue,
+    # without size new thread is only started when no thread is idle
+    def __init__(self,size=None):
+        self.size = size
+        self.tasks = queue.Queue()
+        self.lock = threading.Lock()
+        self.threads = 0
+        self.idle = 0
+
+    def submit(self,fn,args):
+        # returns event that is set when task is done
+        done = threading.Event()
         self.lock.acquire()
-        toexit = self.toexit
+        if (self.size == None and self.idle <= 0) or (self.size != None and self.threads < self.size):
+            self.threads += 1
+            t = threading.Thread(target=self.run)
+            t.daemon = True
+            t.start()
+        else:
+            self.idle -= 1
         self.lock.release()
-        return toexit
+        self.tasks.put((fn,args,done))
+        return done
+
+    def run(self):
+        while True:
+            fn, args, done = self.tasks.get()
+            try:
+                fn(*args)
+            except Exception:
+                # failed task shouldn't stop the thread, error is
+                # reported later from main thread
+                async_errors.append(traceback.format_exc())
+            done.set()
+            self.lock.acquire()
+            self.idle += 1
+            self.lock.release()
+
+class AsyncTasks:
+    # group of tasks in worker pool that is waited for, tasks aren't run
+    # once output is exited, at most limit tasks are pending if given
+    def __init__(self,pool,output,limit=None):
+        self.pool = pool
+        self.output = output
+        self.limit = limit
+        self.pending = 0
+        self.cond = threading.Condition()
+
+    def submit(self,fn,args):
+        self.cond.acquire()
+        while self.limit != None and self.pending >= self.limit and not self.output.toExit():
+            self.cond.wait(0.05)
+        self.pending += 1
+        self.cond.release()
+        self.pool.submit(self.run,(fn,args,))
+
+    def run(self,fn,args):
+        try:
+            if not self.output.toExit():
+                fn(*args)
+        finally:
+            self.cond.acquire()
+            self.pending -= 1
+            self.cond.notify_all()
+            self.cond.release()
+
+    def wait(self):
+        # returns right away if output is exited
+        self.cond.acquire()
+        while self.pending > 0 and not self.output.toExit():
+            self.cond.wait(0.05)
+        self.cond.release()
+
+# errors of tasks that failed in background threads
+async_errors = collections.deque()
+
+def AsyncReportErrors():
+    while len(async_errors) > 0:
+        for line in async_errors.popleft().rstrip().split('\n'):
+            vim.command("echohl ErrorMsg | echomsg '"+line.replace("'","''")+"' | echohl None")
+
+def AsyncRun(output,search,args):
+    # output is exited even if search fails so it isn't waited for forever
+    try:
+        search(*args)
+    finally:
+        output.exit()
+
+# searches run in search pool and can wait for tasks in worker pool
+async_search_pool = AsyncThreadPool()
+async_worker_pool = AsyncThreadPool(max(2,multiprocessing.cpu_count()*2-1))
+
+class AsyncScheduler:
+    # search is started only after pattern stops changing for delay seconds
+    # and previous search has stopped, so at most one search is live
+    def __init__(self):
+        self.search = None
+        self.due = 0
+        self.done = None
+
+    def schedule(self,delay,timeout,output,search,args):
+        # if timeout is given started search is waited for that many seconds
+        self.search = (timeout,output,search,args)
+        self.due = time.time()+delay
+        self.poll()
+
+    def cancel(self):
+        self.search = None
+
+    def poll(self):
+        now = time.time()
+        if self.search == None or now < self.due:
+            return
+        # previous search is given a second to notice it should exit
+        if self.done != None and not self.done.is_set() and now < self.due+1.0:
+            return
+        timeout, output, search, args = self.search
+        self.search = None
+        self.done = async_search_pool.submit(AsyncRun,(output,search,args,))
+        if timeout != None:
+            self.done.wait(timeout)
+
+async_scheduler = AsyncScheduler()
+async_grep_scheduler = AsyncScheduler()
 
 class AsyncGlobber:
     def __init__(self,output):
@@ -66,68 +368,138 @@ class AsyncGlobber:
         self.case_sensitive = False
         self.ignore_dirs = []
         self.ignore_files = []
-        self.buffers = []
-        self.files = []
+        self.buffer_set = set()
+        self.file_set = set()
+        self.matches = []
+        self.ranked = isinstance(output,AsyncRankedOutput)
+        self.index = None
+        self.git = None
+        self.key = None
+        self.complete = False
+        self.matchers = {}
+        self.pool = None
+        self.local = threading.local()
         self.cwd = os.getcwd()+os.path.sep
 
+    def emit(self,line):
+        # output is buffered per thread and published in batches
+        try:
+            batch = self.local.batch
+        except AttributeError:
+            batch = self.local.batch = []
+        batch.append(line)
+        if len(batch) >= 256:
+            self.flush()
+
+    def flush(self):
+        batch = getattr(self.local,'batch',None)
+        if batch:
+            self.local.batch = []
+            self.output.extend(batch)
+
+    def unique(self,kind,p):
+        # dedup stage shared by buffers, files and most recently used files
+        # files and directories are skipped if they are already listed as buffers
+        # and most recently used files if they are already listed at all
+        if kind == 'b':
+            self.buffer_set.add(p)
+            return True
+        if p in self.buffer_set:
+            return False
+        if self.ranked:
+            # ranked output skips duplicates itself
+            return True
+        if kind == 'm':
+            return not p in self.file_set
+        self.file_set.add(p)
+        return True
+
     def addDir(self,p):
+        m = p
         if p.startswith(self.dirps):
             p = p[len(self.dirps):] 
-        if not p in self.buffers:
-            self.output.append("d "+p)
-            self.files.append(p)
+        if self.unique('d',p):
+            self.emit("d "+p)
+            self.record('d',m)
 
     def addFile(self,p):
+        m = p
         if p.startswith(self.dirps):
             p = p[len(self.dirps):] 
-        if not p in self.buffers:
-            self.output.append("f "+p)
-            self.files.append(p)
+        if self.unique('f',p):
+            self.emit("f "+p)
+            self.record('f',m)
 
     def addBuffer(self,p):
+        m = p
         if p.startswith(self.cwd): 
             p = p[len(self.cwd):]
-        self.output.append("b "+p)
-        self.buffers.append(p)
+        self.unique('b',p)
+        self.emit("b "+p)
+        self.record('b',m)
 
     def addMruFile(self,p):
+        m = p
         if p.startswith(self.cwd): 
             p = p[len(self.cwd):]
-        if (not p in self.buffers) and (not p in self.files):
-            self.output.append("m "+p)
+        if self.unique('m',p):
+            self.emit("m "+p)
+            self.record('m',m)
 
-    def fnmatch(self,f,p):
-        if self.case_sensitive:
-            return fnmatch.fnmatchcase(f,p)
+    def record(self,t,m):
+        # matches are kept to refine next search, ranked output keeps only
+        # best results so there matches are kept up to async_refine_matches
+        # and next search isn't refined if there are more
+        matches = self.matches
+        if matches == None:
+            return
+        if self.ranked and len(matches) >= async_refine_matches:
+            self.matches = None
+            return
+        matches.append((t,m))
+
+    def matcher(self,p):
+        # compiled matcher is cached for pattern or list of patterns
+        if isinstance(p,list):
+            k = tuple(p)
         else:
-            return fnmatch.fnmatch(f.lower(),p.lower())
+            k = p
+        m = self.matchers.get(k)
+        if m == None:
+            if isinstance(p,list):
+                m = AsyncCompile(p,self.case_sensitive)
+            else:
+                m = AsyncCompile([p],self.case_sensitive)
+            self.matchers[k] = m
+        return m
+
+    def fnmatch(self,f,p):
+        return self.matcher(p)(f) != None
 
     def has_magic(self,p):
         return '*' in p or '?' in p or '[' in p
 
     def fnmatch_list(self,f,l):
-        for p in l:
-            if self.fnmatch(f,p):
-                return True
-        return False
+        return self.matcher(l)(f) != None
 
     def glob_buffers(self,buffers,pattern):
         if buffers == None:
             return
-        pattern = '*'.join(pattern.split('**'))
+        match = self.matcher('*'.join(pattern.split('**')))
         for buf in buffers:
-            if buf != None and self.fnmatch(buf,pattern):
+            if buf != None and match(buf):
                 self.addBuffer(buf)
 
     def glob_mru_files(self,mru_list,pattern):
         if mru_list == None:
             return
-        pattern = '*'.join(pattern.split('**'))
+        match = self.matcher('*'.join(pattern.split('**')))
+        ignore_file = self.matcher(self.ignore_files)
         for mru in mru_list:
             if mru != None:
                 mru = mru.strip() 
-                if self.fnmatch(mru,pattern):
-                    if not self.fnmatch_list(mru,self.ignore_files):
+                if match(mru):
+                    if not ignore_file(mru):
                         self.addMruFile(mru)
 
     def glob(self,dir,pattern):
@@ -141,6 +513,43 @@ class AsyncGlobber:
                 else:
                     self.addFile(pattern)
             return
+        (pre,post,recurse) = self.parse(dir,pattern)
+        # use git file list or file index for recursive search if it's available
+        if recurse:
+            for index in (self.git,self.index):
+                if index == None:
+                    continue
+                tree = index.get()
+                if tree != None and self.walk_tree(tree,pre,post):
+                    return
+        self.walk(pre,post,recurse)
+
+    def refine(self,glob,pattern):
+        # filter matches of previous search instead of searching again
+        self.dir = glob.dir
+        self.dirps = glob.dirps
+        match = None
+        if self.dir != None and self.has_magic(pattern):
+            match = self.matcher(self.parse(self.dir,pattern)[1])
+        bmatch = self.matcher('*'.join(pattern.split('**')))
+        i = 0
+        for (t,p) in glob.matches:
+            i += 1
+            if i % 1000 == 0 and self.output.toExit():
+                return
+            if t == 'b':
+                if bmatch(p):
+                    self.addBuffer(p)
+            elif t == 'm':
+                if bmatch(p):
+                    self.addMruFile(p)
+            elif match != None and match(p):
+                if t == 'd':
+                    self.addDir(p)
+                else:
+                    self.addFile(p)
+
+    def parse(self,dir,pattern):
         pattern = list(pattern.split(os.path.sep))
         rec_index = None
         mag_index = None
@@ -168,123 +577,509 @@ class AsyncGlobber:
         # normalize path removing double //
         pre = pre.replace(os.path.sep+os.path.sep,os.path.sep)
         post = post.replace(os.path.sep+os.path.sep,os.path.sep)
-        self.walk(pre,post,rec_index != None)
+        return (pre,post,rec_index != None)
 
-    def walk(self,dir, pattern, recurse=True):
-        i = 0
-        walkQueue = None
-        resultQueue = None
-        threads = None
-        for root, dirs, files in os.walk(dir):
+    def walk_tree(self,tree,dir,pattern):
+        rel = os.path.normpath(dir)
+        if os.path.isabs(rel) or rel == os.pardir or rel.startswith(os.pardir+os.path.sep):
+            return False
+        if rel == os.curdir:
+            rel = ''
+        # directories that aren't indexed like symbolic links or
+        # ignored directories are walked instead
+        if not rel in tree:
+            return False
+        match = self.matcher(pattern)
+        pool = None
+        if self.pool != None:
+            pool = AsyncPoolMatcher(self,pattern)
+        stack = [(rel,dir)]
+        while len(stack) > 0:
             if self.output.toExit():
-                return
-            if self.fnmatch_list(root,self.ignore_dirs):
+                return True
+            (rel,root) = stack.pop()
+            if not rel in tree:
                 continue
-            i += 1
-            if i == 1000:
-                threadsCount = multiprocessing.cpu_count()*2-1
-                walkQueue = queue.Queue(threadsCount*20)
-                resultQueue = queue.Queue(threadsCount*20)
-                threads = []
-                for ti in range(threadsCount):
-                    t = threading.Thread(target=self.walkThread, args=(walkQueue,resultQueue,pattern))
-                    t.daemon = True
-                    threads.append(t)
-                    t.start()
-            if i >= 1000:
-                while True:
-                    try:
-                        walkQueue.put((root,dirs,files),True,1)
-                        break
-                    except queue.Full:
-                        if self.output.toExit():
-                            return
-                r = None
-                try:
-                    r = resultQueue.get_nowait()
-                except queue.Empty:
-                    pass
-                if r != None:
-                    (rdirs,rfiles) = r
-                    for rdir in rdirs:
-                        self.addDir(rdir)
-                    for rfile in rfiles:
-                        self.addFile(rfile)
+            (mtime,dirs,files) = tree[rel]
+            if pool != None:
+                for d in dirs:
+                    pool.add('d',os.path.join(root,d),d)
+                for f in files:
+                    pool.add('f',os.path.join(root,f),f)
             else:
-                dirs[:] = [d for d in dirs if not self.fnmatch_list(d,self.ignore_dirs)]
                 for d in dirs:
-                    if self.fnmatch(os.path.join(root,d),pattern):
+                    if match(os.path.join(root,d)):
                         self.addDir(os.path.join(root,d))
                 for f in files:
-                    if self.fnmatch(os.path.join(root,f),pattern):
-                        if not self.fnmatch_list(f,self.ignore_files):
-                            self.addFile(os.path.join(root,f))
-                if not recurse:
+                    if match(os.path.join(root,f)):
+                        self.addFile(os.path.join(root,f))
+            for d in reversed(dirs):
+                if len(rel) > 0:
+                    stack.append((rel+os.path.sep+d,os.path.join(root,d)))
+                else:
+                    stack.append((d,os.path.join(root,d)))
+        if pool != None:
+            pool.wait()
+        return True
+
+    def walk(self,dir, pattern, recurse=True):
+        match = self.matcher(pattern)
+        ignore_file = self.matcher(self.ignore_files)
+        pool = None
+        if self.pool != None and recurse:
+            pool = AsyncPoolMatcher(self,pattern)
+        def visit(root,dirs,files):
+            if pool != None:
+                for d in dirs:
+                    pool.add('d',d.path,d.name)
+                for f in files:
+                    pool.add('f',f.path,f.name)
+                return
+            for d in dirs:
+                if match(d.path):
+                    self.addDir(d.path)
+            for f in files:
+                if match(f.path):
+                    if not ignore_file(f.name):
+                        self.addFile(f.path)
+            self.flush()
+        walker = AsyncWalker(self.output,self.matcher(self.ignore_dirs),visit)
+        walker.walk(dir,recurse)
+        if pool != None:
+            pool.wait()
+
+class AsyncPoolMatcher:
+    # sends candidate paths in chunks to process pool for matching
+    def __init__(self,glob,pattern):
+        self.glob = glob
+        self.args = (pattern,glob.ignore_files,glob.case_sensitive)
+        self.lock = threading.Lock()
+        self.chunk = []
+        self.results = []
+
+    def add(self,kind,path,name):
+        self.lock.acquire()
+        self.chunk.append((kind,path,name))
+        if len(self.chunk) >= 1000:
+            self.submit()
+        self.lock.release()
+
+    def submit(self):
+        chunk = self.chunk
+        self.chunk = []
+        try:
+            self.results.append(self.glob.pool.apply_async(AsyncMatchChunk,self.args+(chunk,),callback=self.matched))
+        except (ValueError,AssertionError):
+            # pool was shut down
+            pass
+
+    def matched(self,matches):
+        if self.glob.output.toExit():
+            return
+        for (kind,path) in matches:
+            if kind == 'd':
+                self.glob.addDir(path)
+            else:
+                self.glob.addFile(path)
+        self.glob.flush()
+
+    def wait(self):
+        self.lock.acquire()
+        if len(self.chunk) > 0:
+            self.submit()
+        self.lock.release()
+        for r in self.results:
+            while not r.ready():
+                if self.glob.output.toExit():
                     return
-        if walkQueue == None:
+                r.wait(0.05)
+
+def AsyncMatchChunk(pattern,ignore_files,case_sensitive,chunk):
+    # runs inside process pool worker
+    global async_match_cache
+    key = (pattern,tuple(ignore_files),case_sensitive)
+    m = async_match_cache.get(key)
+    if m == None:
+        if len(async_match_cache) > 16:
+            async_match_cache.clear()
+        m = (AsyncCompile([pattern],case_sensitive),AsyncCompile(ignore_files,case_sensitive))
+        async_match_cache[key] = m
+    (match,ignore_file) = m
+    matches = []
+    for (kind,path,name) in chunk:
+        if match(path):
+            if kind == 'd' or not ignore_file(name):
+                matches.append((kind,path))
+    return matches
+
+def AsyncMatchPool(processes):
+    global async_match_pool
+    if async_match_pool == None:
+        context = multiprocessing
+        if hasattr(multiprocessing,'get_context'):
+            # vim is the executable so worker processes can only be forked
+            context = multiprocessing.get_context('fork')
+        async_match_pool = context.Pool(processes)
+    return async_match_pool
+
+def AsyncMatchPoolShutdown():
+    global async_match_pool
+    if async_match_pool != None:
+        async_match_pool.terminate()
+        async_match_pool.join()
+        async_match_pool = None
+
+class AsyncDirEntry:
+    # os.DirEntry replacement used when os.scandir isn't available
+    def __init__(self,dir,name):
+        self.name = name
+        self.path = os.path.join(dir,name)
+        self.st = None
+
+    def is_dir(self):
+        return os.path.isdir(self.path)
+
+    def is_symlink(self):
+        return os.path.islink(self.path)
+
+    def stat(self):
+        if self.st == None:
+            self.st = os.stat(self.path)
+        return self.st
+
+def AsyncScanDir(dir):
+    if async_scandir != None:
+        return async_scandir(dir)
+    return [AsyncDirEntry(dir,n) for n in os.listdir(dir)]
+
+class AsyncWalker:
+    def __init__(self,output,ignore_dir,visit):
+        self.output = output
+        self.ignore_dir = ignore_dir
+        self.visit = visit
+        self.tasks = AsyncTasks(async_worker_pool,output)
+
+    def walk(self,dir,recurse=True):
+        if not recurse:
+            self.scan(dir,False)
             return
-        while not resultQueue.empty():
-            if self.output.toExit():
-                return
-            r = None
+        # directories are scanned in parallel by worker pool, each
+        # scanned directory submits its sub-directories
+        self.tasks.submit(self.walkDir,(dir,))
+        self.tasks.wait()
+
+    def walkDir(self,dir):
+        for d in self.scan(dir,True):
+            self.tasks.submit(self.walkDir,(d,))
+
+    def scan(self,dir,recurse):
+        # ignored sub-directories are skipped by name, so directory that
+        # pattern starts from is scanned even if it's ignored
+        try:
+            entries = AsyncScanDir(dir)
+        except OSError:
+            return []
+        dirs = []
+        files = []
+        subdirs = []
+        for e in entries:
             try:
-                r = resultQueue.get_nowait()
-            except queue.Empty:
-                pass
-            if r != None:
-                (rdirs,rfiles) = r
-                for rdir in rdirs:
-                    self.addDir(rdir)
-                for rfile in rfiles:
-                    self.addFile(rfile)
-        walkQueue.join()
-        while not resultQueue.empty():
-            if self.output.toExit():
-                return
-            r = None
+                isdir = e.is_dir()
+            except OSError:
+                isdir = False
+            if isdir:
+                if self.ignore_dir(e.name):
+                    continue
+                dirs.append(e)
+                # like os.walk don't follow symbolic links to directories
+                if recurse and not e.is_symlink():
+                    subdirs.append(e.path)
+            else:
+                files.append(e)
+        self.visit(dir,dirs,files)
+        return subdirs
+
+class AsyncFileIndex:
+    def __init__(self,cwd,path,ignore_dirs,ignore_files):
+        self.cwd = cwd
+        self.path = path
+        self.glob = AsyncGlobber(None)
+        self.glob.ignore_dirs = ignore_dirs
+        self.glob.ignore_files = ignore_files
+        self.lock = threading.Lock()
+        self.tree = None
+        self.loaded = False
+        self.building = False
+        self.refreshed = 0
+
+    def get(self):
+        self.lock.acquire()
+        try:
+            if not self.loaded:
+                self.loaded = True
+                self.tree = self.load()
+            if self.building:
+                return self.tree
+            if self.tree == None:
+                self.building = True
+                async_search_pool.submit(self.build,())
+                return None
+            if time.time()-self.refreshed < async_index_refresh_interval:
+                return self.tree
+            self.building = True
+        finally:
+            self.lock.release()
+        # refresh is done in the calling search thread
+        tree = self.refresh(self.tree)
+        self.lock.acquire()
+        self.tree = tree
+        self.building = False
+        self.lock.release()
+        return tree
+
+    def load(self):
+        try:
+            f = open(self.path,'rb')
             try:
-                r = resultQueue.get_nowait()
-            except queue.Empty:
-                pass
-            if r != None:
-                (rdirs,rfiles) = r
-                for rdir in rdirs:
-                    self.addDir(rdir)
-                for rfile in rfiles:
-                    self.addFile(rfile)
-
-    def walkThread(self,walkQueue,resultQueue,pattern):
-        while True:
-            if self.output.toExit():
-                return
-            t = None
+                index = pickle.loads(zlib.decompress(f.read()))
+            finally:
+                f.close()
+            if index['cwd'] == self.cwd:
+                return index['tree']
+        except Exception:
+            pass
+        return None
+
+    def save(self,tree):
+        try:
+            d = os.path.dirname(self.path)
+            if not os.path.isdir(d):
+                os.makedirs(d)
+            tmp = self.path+'.'+str(os.getpid())
+            f = open(tmp,'wb')
             try:
-                t = walkQueue.get_nowait()
-            except queue.Empty:
-                pass
-            if t == None:
-                time.sleep(0.01)
+                f.write(zlib.compress(pickle.dumps({'cwd': self.cwd, 'tree': tree},2)))
+            finally:
+                f.close()
+            if async_on_windows and os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(tmp,self.path)
+        except (IOError,OSError):
+            pass
+
+    def join(self,rel,name):
+        if len(rel) > 0:
+            return rel+os.path.sep+name
+        return name
+
+    def list(self,rel):
+        path = os.path.join(self.cwd,rel)
+        try:
+            mtime = os.stat(path).st_mtime
+            entries = AsyncScanDir(path)
+        except OSError:
+            return None
+        ignore_dir = self.glob.matcher(self.glob.ignore_dirs)
+        ignore_file = self.glob.matcher(self.glob.ignore_files)
+        dirs = []
+        files = []
+        for e in entries:
+            try:
+                isdir = e.is_dir()
+            except OSError:
+                isdir = False
+            if isdir:
+                if not ignore_dir(e.name):
+                    dirs.append(e.name)
+            elif not ignore_file(e.name):
+                files.append(e.name)
+        return (mtime,dirs,files)
+
+    def scan(self,tree,rel):
+        stack = [rel]
+        while len(stack) > 0:
+            rel = stack.pop()
+            entry = self.list(rel)
+            if entry == None:
                 continue
-            (root,dirs,files) = t
-            rdirs = []
-            rfiles = []
-            dirs[:] = [d for d in dirs if not self.fnmatch_list(d,self.ignore_dirs)]
-            for d in dirs:
-                if self.fnmatch(os.path.join(root,d),pattern):
-                    rdirs.append(os.path.join(root,d))
-            for f in files:
-                if self.fnmatch(os.path.join(root,f),pattern):
-                    if not self.fnmatch_list(f,self.ignore_files):
-                        rfiles.append(os.path.join(root,f))
-            if len(rdirs) > 0 or len(rfiles) > 0:
-                while True:
-                    try:
-                        resultQueue.put((rdirs,rfiles),True,1)
+            tree[rel] = entry
+            for d in reversed(entry[1]):
+                d = self.join(rel,d)
+                # like os.walk don't follow symbolic links to directories
+                if not os.path.islink(os.path.join(self.cwd,d)):
+                    stack.append(d)
+
+    def build(self):
+        tree = {}
+        self.scan(tree,'')
+        self.save(tree)
+        self.lock.acquire()
+        self.tree = tree
+        self.building = False
+        self.refreshed = time.time()
+        self.lock.release()
+
+    def refresh(self,old):
+        # stat every indexed directory and rescan only those
+        # whose modification time changed since last refresh
+        tree = {}
+        changed = False
+        stack = ['']
+        while len(stack) > 0:
+            rel = stack.pop()
+            entry = old.get(rel)
+            if entry == None:
+                changed = True
+                self.scan(tree,rel)
+                continue
+            try:
+                mtime = os.stat(os.path.join(self.cwd,rel)).st_mtime
+            except OSError:
+                changed = True
+                continue
+            if mtime != entry[0]:
+                changed = True
+                entry = self.list(rel)
+                if entry == None:
+                    continue
+            tree[rel] = entry
+            for d in reversed(entry[1]):
+                d = self.join(rel,d)
+                if d in old or not os.path.islink(os.path.join(self.cwd,d)):
+                    stack.append(d)
+        if changed:
+            self.save(tree)
+        self.refreshed = time.time()
+        return tree
+
+def AsyncIndex(index_dir,ignore_dirs,ignore_files):
+    global async_indexes
+    cwd = os.getcwd()
+    key = hashlib.sha1(AsyncEncode('\0'.join([cwd,ignore_dirs,ignore_files]))).hexdigest()
+    if not key in async_indexes:
+        path = os.path.join(os.path.expanduser(index_dir),'files-'+key)
+        async_indexes[key] = AsyncFileIndex(cwd,path,eval(ignore_dirs),eval(ignore_files))
+    return async_indexes[key]
+
+class AsyncGitFiles:
+    # files listed by git, tracked ones and untracked ones that aren't
+    # ignored by .gitignore, in the same tree format as file index,
+    # list is refreshed in background and previous one is used meanwhile
+    def __init__(self,cwd,ignore_dirs,ignore_files):
+        self.cwd = cwd
+        self.glob = AsyncGlobber(None)
+        self.glob.ignore_dirs = ignore_dirs
+        self.glob.ignore_files = ignore_files
+        self.lock = threading.Lock()
+        self.tree = None
+        self.names = None
+        self.refreshed = 0
+        self.refreshing = None
+
+    def get(self):
+        self.update()
+        self.lock.acquire()
+        tree = self.tree
+        self.lock.release()
+        return tree
+
+    def files(self):
+        self.update()
+        self.lock.acquire()
+        names = self.names
+        self.lock.release()
+        return names
+
+    def update(self):
+        # first list is waited for since there's no previous one to use
+        self.lock.acquire()
+        try:
+            done = self.refreshing
+            if done == None and time.time()-self.refreshed >= async_index_refresh_interval:
+                done = self.refreshing = async_search_pool.submit(self.refresh,())
+        finally:
+            self.lock.release()
+        if done != None and self.refreshed == 0:
+            done.wait()
+
+    def git(self,args):
+        # returns None if git isn't available or cwd isn't inside git repository
+        try:
+            p = subprocess.Popen(['git','ls-files','-z']+args, cwd=self.cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            out = p.communicate()[0]
+        except OSError:
+            return None
+        if p.returncode != 0:
+            return None
+        return [AsyncDecode(n) for n in out.split(b'\0') if len(n) > 0]
+
+    def list(self):
+        names = self.git(['--cached','--others','--exclude-standard'])
+        if names == None:
+            return None
+        # tracked files deleted from working tree are still listed as cached
+        deleted = self.git(['--deleted'])
+        if deleted != None and len(deleted) > 0:
+            deleted = set(deleted)
+            names = [n for n in names if not n in deleted]
+        return names
+
+    def join(self,rel,name):
+        if len(rel) > 0:
+            return rel+os.path.sep+name
+        return name
+
+    def refresh(self):
+        try:
+            tree, files = self.build(self.list())
+            self.lock.acquire()
+            self.tree = tree
+            self.names = files
+            self.lock.release()
+        finally:
+            self.lock.acquire()
+            self.refreshed = time.time()
+            self.refreshing = None
+            self.lock.release()
+
+    def build(self,names):
+        if names == None:
+            return None, None
+        ignore_dir = self.glob.matcher(self.glob.ignore_dirs)
+        ignore_file = self.glob.matcher(self.glob.ignore_files)
+        tree = {'': (None,[],[])}
+        ignored = set()
+        files = []
+        for name in names:
+            if os.path.sep != '/':
+                name = name.replace('/',os.path.sep)
+            parts = name.split(os.path.sep)
+            if ignore_file(parts[-1]):
+                continue
+            rel = ''
+            for d in parts[:-1]:
+                sub = self.join(rel,d)
+                if not sub in tree:
+                    if sub in ignored or ignore_dir(d):
+                        ignored.add(sub)
+                        rel = None
                         break
-                    except queue.Full:
-                        if self.output.toExit():
-                            return
-            walkQueue.task_done()
+                    tree[rel][1].append(d)
+                    tree[sub] = (None,[],[])
+                rel = sub
+            if rel == None:
+                continue
+            tree[rel][2].append(parts[-1])
+            files.append(os.path.join(self.cwd,name))
+        return tree, files
+
+def AsyncGit(ignore_dirs,ignore_files):
+    global async_git_files
+    cwd = os.getcwd()
+    key = (cwd,ignore_dirs,ignore_files)
+    if not key in async_git_files:
+        async_git_files[key] = AsyncGitFiles(cwd,eval(ignore_dirs),eval(ignore_files))
+    return async_git_files[key]
 
 
 def AsyncRefreshN():
@@ -295,13 +1090,18 @@ def AsyncRefreshI():
     AsyncRefresh()
     vim.command("call <SID>MoveCursorI()")
 
+def AsyncRefreshT():
+    if AsyncRefresh():
+        return 1
+    return 0
+
 def AsyncRefresh():
-    global async_pattern, async_prev_pattern, async_prev_mode, async_output
+    global async_pattern, async_prev_pattern, async_prev_mode, async_output, async_glob, async_renderer
     # detect quit
     cl = len(vim.current.buffer[0])
     if cl < 2:
         vim.command("bd!")
-        return
+        return False
     elif cl < 3:
         vim.current.buffer[0] = '>  '
     mode = vim.eval("getbufvar('%','asyncfinder_mode')")
@@ -318,15 +1118,27 @@ def AsyncRefresh():
             # Remove ouput
             if len(vim.current.buffer) > 1:
                 vim.current.buffer[1:] = None
+            async_renderer.reset()
             if async_output != None:
                 async_output.exit()
-            async_output = AsyncOutput() 
+            prev_pattern = async_pattern
             async_pattern = pattern
             speed_mode = vim.eval("g:asyncfinder_speed_mode") == '1'
             match_exact = vim.eval("g:asyncfinder_match_exact") == '1'
             match_camel_case = vim.eval("g:asyncfinder_match_camel_case") == '1'
+            match_fuzzy = vim.eval("g:asyncfinder_match_fuzzy") == '1'
+            if match_fuzzy:
+                async_output = AsyncRankedOutput(AsyncFuzzyQuery(pattern),int(vim.eval("g:asyncfinder_match_fuzzy_limit")))
+            else:
+                async_output = AsyncOutput() 
             ignore_dirs = vim.eval("g:asyncfinder_ignore_dirs")
             ignore_files = vim.eval("g:asyncfinder_ignore_files")
+            index = None
+            if vim.eval("g:asyncfinder_use_index") == '1':
+                index = AsyncIndex(vim.eval("g:asyncfinder_index_dir"),ignore_dirs,ignore_files)
+            git = None
+            if vim.eval("g:asyncfinder_use_git") == '1':
+                git = AsyncGit(ignore_dirs,ignore_files)
             # Get buffer list
             if ('a' in mode or 'b' in mode) and vim.eval("g:asyncfinder_include_buffers") == "1":
                 buf_list = vim.eval("map(filter(range(1,bufnr(\"$\")), \"buflisted(v:val) && bufname(v:val) != ''\"),\"bufname(v:val)\")")
@@ -335,26 +1147,50 @@ def AsyncRefresh():
             mru_file = ""
             if ('a' in mode or 'm' in mode) and vim.eval("g:asyncfinder_include_mru_files") == "1" and vim.eval("exists('MRU_File')") == "1":
                 mru_file = vim.eval("MRU_File")
-            # Disable speed mode when doing recursive file search
-            if speed_mode:
-                if ('a' in mode or 'f' in mode) and '**' in pattern:
-                    speed_mode = False
-            if speed_mode:
-                AsyncSearch(async_output,mode,pattern,buf_list,mru_file,match_exact,match_camel_case,ignore_dirs,ignore_files)
+            # Narrow previous results if pattern only extends previous pattern
+            key = (mode,match_exact,match_camel_case,match_fuzzy,ignore_dirs,ignore_files,buf_list,mru_file,os.getcwd(),git != None)
+            prev_glob = async_glob
+            async_glob = AsyncGlobber(async_output)
+            async_glob.key = key
+            processes = int(vim.eval("g:asyncfinder_match_processes"))
+            if processes > 0 and not async_on_windows:
+                async_glob.pool = AsyncMatchPool(processes)
+            if prev_glob != None and prev_glob.complete and prev_glob.matches != None and prev_glob.key == key and AsyncRefines(prev_pattern,pattern,match_exact):
+                search = AsyncRefine
+                args = (async_output,async_glob,prev_glob,pattern,match_exact,match_camel_case,match_fuzzy,)
             else:
-                t = threading.Thread(target=AsyncSearch, args=(async_output,mode,pattern,buf_list,mru_file,match_exact,match_camel_case,ignore_dirs,ignore_files,))
-                t.daemon = True
-                t.start()
+                search = AsyncSearch
+                args = (async_output,mode,pattern,buf_list,mru_file,match_exact,match_camel_case,ignore_dirs,ignore_files,index,async_glob,match_fuzzy,git,)
+            # speed mode waits for search a bit so that results are shown at once
+            timeout = None
+            if speed_mode:
+                timeout = int(vim.eval("g:asyncfinder_speed_mode_timeout"))/1000.0
+            async_scheduler.schedule(int(vim.eval("g:asyncfinder_debounce"))/1000.0,timeout,async_output,search,args)
     else:
         if len(vim.current.buffer) > 1:
             vim.current.buffer[1:] = None
         async_pattern = None
+        async_glob = None
+        async_scheduler.cancel()
+        async_renderer.reset()
         if async_output != None:
             async_output.exit()
             async_output = None
+    async_scheduler.poll()
+    AsyncReportErrors()
     running = async_output != None and not async_output.toExit()
+    more = 0
+    if isinstance(async_output,AsyncRankedOutput):
+        # ranked output is redrawn only when best results change
+        output = async_output.get()
+        if output != None:
+            vim.current.buffer[1:] = output
+    else:
+        more = async_renderer.render(async_output,int(vim.eval("g:asyncfinder_max_lines")),int(vim.eval("g:asyncfinder_refresh_lines")))
     status = None
     status_mode='(%#AsyncFinderTitle#mode:%* '+mode+' %#AsyncFinderTitle#cwd:%* '+os.getcwd()+')'
+    if more > 0:
+        status_mode += ' %#AsyncFinderTitle#'+str(more)+' more%*'
     if running:
         dots = '.'*random.randint(1,3)
         dots = dots+' '*(3-len(dots))
@@ -362,21 +1198,62 @@ def AsyncRefresh():
     else:
         status = '%#AsyncFinderTitle#Type your pattern%* '+status_mode
     vim.eval("s:SetStatus('"+status.replace("'","''")+"')")
-    if async_output != None:
-        output = async_output.get()
-        if len(output) > 0:
-            vim.current.buffer.append(output)
+    # refresh is needed until search finishes and all results are shown
+    return running or len(async_renderer.pending) > 0
 
-def AsyncSearch(output,mode,pattern,buf_list, mru_file, match_exact, match_camel_case, ignore_dirs,ignore_files):
-    global async_on_windows
-    if output.toExit():
-        return
-    if async_on_windows:
-        pattern = pattern.replace('/','\\')
-    glob = AsyncGlobber(output)
-    glob.ignore_dirs = eval(ignore_dirs)
-    glob.ignore_files = eval(ignore_files)
+def AsyncFuzzyQuery(pattern):
+    pattern = pattern.replace('/',os.path.sep).split(os.path.sep)[-1]
+    return ''.join([c for c in pattern if not c in '*?[]^$'])
+
+def AsyncScore(query,path):
+    # score subsequence match of lowercase query in path
+    # returns None if path doesn't match
+    if len(query) == 0:
+        return 0
+    lpath = path.lower()
+    if len(lpath) != len(path):
+        # some characters are longer in lowercase, case and boundaries
+        # are taken from original character of each lowercase character
+        path = [c for c in path for l in c.lower()]
+    base = lpath.rfind(os.path.sep)+1
+    # prefer matching whole query inside file name
+    i = base
+    for c in query:
+        i = lpath.find(c,i)
+        if i < 0:
+            break
+        i += 1
+    if i < 0:
+        i = 0
+    else:
+        i = base
+    score = 0.0
+    prev = -2
+    for c in query:
+        i = lpath.find(c,i)
+        if i < 0:
+            return None
+        score += 1
+        if i == prev+1:
+            score += 5
+        if i == 0 or path[i-1] in '/\\_-. ' or (path[i].isupper() and path[i-1].islower()):
+            score += 4
+        if i >= base:
+            score += 2
+        prev = i
+        i += 1
+    return score-len(path)*0.01
+
+def AsyncPattern(pattern,match_exact,match_camel_case,match_fuzzy=False):
     pattern = pattern.split(os.path.sep)
+    if match_fuzzy:
+        # match any path that contains query as subsequence
+        query = AsyncFuzzyQuery(pattern[-1])
+        if '**' in pattern[-1]:
+            pattern[-1] = '**'+'*'.join(query)+'*'
+        else:
+            pattern[-1] = '*'+'*'.join(query)+'*'
+        return os.path.sep.join(pattern)
     if match_camel_case:
         if len(pattern[-1]) > 1:
             camel = []
@@ -416,9 +1293,37 @@ def AsyncSearch(output,mode,pattern,buf_list, mru_file, match_exact, match_camel
                 pattern[-1] = '*'
     else:
         pattern[-1] = '*'
-    pattern = os.path.sep.join(pattern)
+    return os.path.sep.join(pattern)
+
+def AsyncRefines(prev_pattern,pattern,match_exact):
+    # check if every match of pattern is also a match of prev_pattern
+    if prev_pattern == None or match_exact:
+        return False
+    if len(pattern) <= len(prev_pattern) or not pattern.startswith(prev_pattern):
+        return False
+    if prev_pattern.endswith('$'):
+        return False
+    for c in pattern[len(prev_pattern):]:
+        if c in '*?[]^$/\\' or c == os.path.sep:
+            return False
+    return True
+
+def AsyncSearch(output,mode,pattern,buf_list, mru_file, match_exact, match_camel_case, ignore_dirs,ignore_files, index=None, glob=None, match_fuzzy=False, git=None):
+    global async_on_windows
+    if output.toExit():
+        return
+    if async_on_windows:
+        pattern = pattern.replace('/','\\')
+    if glob == None:
+        glob = AsyncGlobber(output)
+    glob.ignore_dirs = eval(ignore_dirs)
+    glob.ignore_files = eval(ignore_files)
+    glob.index = index
+    glob.git = git
+    pattern = AsyncPattern(pattern,match_exact,match_camel_case,match_fuzzy)
     if 'a' in mode or 'b' in mode:
         glob.glob_buffers(buf_list,pattern)
+        glob.flush()
     if output.toExit():
         return
     if 'a' in mode or 'f' in mode:
@@ -433,14 +1338,33 @@ def AsyncSearch(output,mode,pattern,buf_list, mru_file, match_exact, match_camel
                 glob.glob_mru_files(mru_list,pattern)
             except IOError:
                 pass
+    glob.flush()
+    if not output.toExit():
+        glob.complete = True
+    output.exit()
+
+def AsyncRefine(output,glob,prev_glob,pattern,match_exact,match_camel_case,match_fuzzy=False):
+    global async_on_windows
+    if output.toExit():
+        return
+    if async_on_windows:
+        pattern = pattern.replace('/','\\')
+    pattern = AsyncPattern(pattern,match_exact,match_camel_case,match_fuzzy)
+    glob.refine(prev_glob,pattern)
+    glob.flush()
+    if not output.toExit():
+        glob.complete = True
     output.exit()
 
 def AsyncCancel():
-    global async_pattern, async_output
+    global async_pattern, async_output, async_glob
     async_pattern = None
+    async_glob = None
+    async_scheduler.cancel()
     if async_output != None:
         async_output.exit()
         async_output = None
+    AsyncMatchPoolShutdown()
 
 def AsyncGrepRefreshN():
     AsyncGrepRefresh()
@@ -450,13 +1374,18 @@ def AsyncGrepRefreshI():
     AsyncGrepRefresh()
     vim.command("call <SID>MoveCursorI()")
 
+def AsyncGrepRefreshT():
+    if AsyncGrepRefresh():
+        return 1
+    return 0
+
 def AsyncGrepRefresh():
-    global async_grep_pattern, async_grep_prev_pattern, async_grep_output, async_grep_file_output
+    global async_grep_pattern, async_grep_prev_pattern, async_grep_output, async_grep_renderer
     # detect quit
     cl = len(vim.current.buffer[0])
     if cl < 2:
         vim.command("bd!")
-        return
+        return False
     elif cl < 3:
         vim.current.buffer[0] = '>  '
     pattern = vim.current.buffer[0]
@@ -473,28 +1402,41 @@ def AsyncGrepRefresh():
             # Remove ouput
             if async_grep_output != None:
                 async_grep_output.exit()
-            if async_grep_file_output != None:
-                async_grep_file_output.exit()
             if len(vim.current.buffer) > 1:
                 vim.current.buffer[1:] = None
-            async_grep_output = AsyncOutput() 
-            async_grep_file_output = None
+            async_grep_renderer.reset()
+            if cmd.startswith('builtin'):
+                async_grep_output = AsyncBoundedOutput(async_grep_max_pending)
+            else:
+                async_grep_output = AsyncOutput() 
+            async_grep_locations.clear()
             cwd = vim.eval("getcwd()")
-            t = None
             if cmd.startswith('builtin'):
-                t = threading.Thread(target=AsyncGrepBuiltin, args=(cmd,cwd))
+                index = None
+                if vim.eval("g:asyncfinder_grep_use_index") == '1':
+                    index = AsyncGrepIndex(vim.eval("g:asyncfinder_index_dir"),vim.eval("g:asyncfinder_grep_ignore_dirs"),vim.eval("g:asyncfinder_grep_ignore_files"))
+                git = None
+                if vim.eval("g:asyncfinder_grep_use_git") == '1':
+                    git = AsyncGit(vim.eval("g:asyncfinder_grep_ignore_dirs"),vim.eval("g:asyncfinder_grep_ignore_files"))
+                search = AsyncGrepBuiltin
+                args = (cmd,cwd,index,git,)
             else:
-                t = threading.Thread(target=AsyncGrep, args=(cmd,cwd))
-            t.daemon = True
-            t.start()
+                search = AsyncGrep
+                args = (cmd,cwd,vim.eval("g:asyncfinder_grep_cmd").endswith('rg'),)
+            async_grep_scheduler.schedule(int(vim.eval("g:asyncfinder_debounce"))/1000.0,None,async_grep_output,search,args)
     else:
         if len(vim.current.buffer) > 1:
             vim.current.buffer[1:] = None
         async_grep_pattern = None
+        async_grep_renderer.reset()
+        async_grep_scheduler.cancel()
         if async_grep_output != None:
             async_grep_output.exit()
             async_grep_output = None
+    async_grep_scheduler.poll()
+    AsyncReportErrors()
     running = async_grep_output != None and not async_grep_output.toExit()
+    more = async_grep_renderer.render(async_grep_output,int(vim.eval("g:asyncfinder_max_lines")),int(vim.eval("g:asyncfinder_refresh_lines")))
     if cmd.startswith('builtin'):
         cmd = 'ignore_files: '+vim.eval("g:asyncfinder_grep_ignore_files")
         cmd += ' ignore_dirs: '+vim.eval("g:asyncfinder_grep_ignore_dirs")
@@ -503,6 +1445,8 @@ def AsyncGrepRefresh():
         if cwd == None:
             cwd = vim.eval("getcwd()")
         cmd += ' cwd: '+cwd
+    if more > 0:
+        cmd += ' %#AsyncGrepTitle#'+str(more)+' more%*'
     status = None
     if running:
         dots = '.'*random.randint(1,3)
@@ -511,14 +1455,11 @@ def AsyncGrepRefresh():
     else:
         status = '%#AsyncGrepTitle#Type your pattern%* ('+cmd+')' 
     vim.eval("s:SetStatus('"+status.replace("'","''")+"')")
-    if async_grep_output != None:
-        output = async_grep_output.get()
-        if len(output) > 0:
-            vim.current.buffer.append(output)
+    return running or len(async_grep_renderer.pending) > 0
 
 
-def AsyncGrepBuiltin(cmd,cwd):
-    global async_grep_output, async_grep_file_output
+def AsyncGrepBuiltin(cmd,cwd,index=None,git=None):
+    global async_grep_output, async_grep_results
     output = async_grep_output
     if output.toExit():
         return
@@ -537,138 +1478,764 @@ def AsyncGrepBuiltin(cmd,cwd):
     pattern = cmd[1:i]
     pattern = pattern.replace("\\'","'")
     cwd = cmd[i+1:].lstrip()
-    async_grep_file_output = AsyncOutput()
-    file_output = async_grep_file_output
-    match_exact = vim.eval("g:asyncfinder_match_exact") == '1'
-    match_camel_case = vim.eval("g:asyncfinder_match_camel_case") == '1'
-    buf_list = []
-    mru_file = ""
-    t = threading.Thread(target=AsyncSearch, args=(file_output,'f','**',buf_list,mru_file,match_exact,match_camel_case,ignore_dirs,ignore_files,))
-    t.daemon = True
-    t.start()
-    if pattern.startswith('/') and pattern.endswith('/'):
+    prev = async_grep_results
+    results = AsyncGrepResults((ignore_case,ignore_files,ignore_dirs,cwd,git != None),pattern)
+    async_grep_results = results
+    pattern, literal = AsyncGrepPattern(pattern,ignore_case)
+    if pattern != None:
+        key = (pattern.pattern,pattern.flags)
+    else:
+        key = literal
+    if prev != None and prev.refines(results):
+        # only files that matched previous pattern are searched
+        groups = [AsyncGrepRefine(output,prev,results)]
+    else:
+        groups = None
+        if git != None:
+            files = git.files()
+            if files != None:
+                groups = [files]
+        if groups == None:
+            # files of each directory are searched as soon as it's scanned
+            groups = AsyncWalkFiles(output,cwd,eval(ignore_dirs),eval(ignore_files))
+        if index != None:
+            # candidate files are only known when all files are found
+            required = literal
+            if required == None and pattern != None:
+                required = AsyncRequiredLiteral(pattern.pattern)
+            names = []
+            for files in groups:
+                names.extend(files)
+            groups = [index.candidates(names,required)]
+    # files are searched by worker pool in chunks to keep task overhead low
+    tasks = AsyncTasks(async_worker_pool,output,64)
+    for files in groups:
+        for i in range(0,len(files),32):
+            output.wait()
+            if output.toExit():
+                break
+            tasks.submit(AsyncGrepFiles,(output,files[i:i+32],pattern,literal,key,cwd,results,))
+    tasks.wait()
+    if not output.toExit():
+        results.complete = True
+    output.exit()
+
+def AsyncWalkFiles(output,dir,ignore_dirs,ignore_files):
+    # yields paths of files in each directory as soon as it's scanned,
+    # directories are walked by worker pool
+    found = queue.Queue()
+    ignore_file = AsyncCompile(ignore_files)
+    def visit(root,dirs,files):
+        found.put([f.path for f in files if not ignore_file(f.name)])
+    walker = AsyncWalker(output,AsyncCompile(ignore_dirs),visit)
+    def walk():
+        try:
+            walker.walk(dir)
+        finally:
+            # end of walk is marked so consumer doesn't wait for timeout
+            found.put(None)
+    async_search_pool.submit(walk,())
+    while not output.toExit():
         try:
+            files = found.get(True,0.05)
+        except queue.Empty:
+            continue
+        if files == None:
+            break
+        yield files
+
+class AsyncGrepResults:
+    # matched lines of each searched file, kept to refine complete builtin
+    # grep when literal pattern is extended, files without matches are kept
+    # too so they are searched again if they are changed
+    def __init__(self,key,pattern):
+        self.key = key
+        self.pattern = pattern
+        self.files = []
+        self.size = 0
+        self.complete = False
+        self.lock = threading.Lock()
+
+    def add(self,fn,lines,st):
+        # lines are None if they weren't kept, file is searched again then
+        self.lock.acquire()
+        # files with too many lines are searched again instead
+        if lines == None or self.size+len(lines) > async_grep_refine_lines:
+            lines = None
+        else:
+            self.size += len(lines)
+        self.files.append((fn,lines,st.st_mtime,st.st_size))
+        self.lock.release()
+
+    def isRegex(self,pattern):
+        return len(pattern) > 1 and pattern.startswith('/') and pattern.endswith('/')
+
+    def refines(self,results):
+        if not self.complete or self.key != results.key:
+            return False
+        if self.isRegex(self.pattern) or self.isRegex(results.pattern):
+            return False
+        if self.key[0]:
+            return self.pattern.lower() in results.pattern.lower()
+        return self.pattern in results.pattern
+
+def AsyncGrepRefine(output,prev,results):
+    # returns files that have to be searched again
+    pattern = results.pattern
+    ignore_case = results.key[0]
+    if ignore_case:
+        pattern = pattern.lower()
+    cwd = results.key[3]
+    files = []
+    for fn, lines, mtime, size in prev.files:
+        if output.toExit():
+            break
+        if lines == None:
+            files.append(fn)
+            continue
+        # files changed since previous search are searched again
+        try:
+            st = os.stat(os.path.join(cwd,fn))
+        except OSError:
+            continue
+        if st.st_mtime != mtime or st.st_size != size:
+            files.append(fn)
+            continue
+        # matched text follows file name and line number
+        n = len(os.path.join(cwd,fn))+1
+        found = []
+        for l in lines:
+            text = l[l.index(':',n)+1:]
             if ignore_case:
-                pattern = re.compile(pattern[1:-1],re.IGNORECASE)
+                text = text.lower()
+            if pattern in text:
+                found.append(l)
+        results.add(fn,found,st)
+        output.extend(found)
+    return files
+
+class AsyncTrigramIndex:
+    # trigrams of words in lowercased file contents, each indexed file gets
+    # a new number and postings of numbers that are no longer used are only
+    # removed when index is compacted, files bigger than max size aren't
+    # indexed and are always searched
+    def __init__(self,cwd,path):
+        self.cwd = cwd
+        self.path = path
+        self.log = path+'.log'
+        self.lock = threading.Lock()
+        self.files = {}
+        self.postings = {}
+        self.next = 0
+        self.dead = 0
+        self.loaded = False
+        self.updating = False
+
+    def candidates(self,names,required):
+        # returns files that can contain required literal, files that
+        # aren't indexed yet or changed since are always returned
+        stats = []
+        for f in names:
+            try:
+                st = os.stat(os.path.join(self.cwd,f))
+            except OSError:
+                continue
+            stats.append((f,st.st_mtime,st.st_size))
+        result = []
+        stale = []
+        self.lock.acquire()
+        try:
+            if not self.loaded:
+                self.loaded = True
+                self.load()
+            ids = None
+            if required != None:
+                ids = self.lookup(required.lower())
+            for f, mtime, size in stats:
+                e = self.files.get(f)
+                if e == None or e[0] != mtime or e[1] != size:
+                    stale.append((f,mtime,size))
+                    result.append(f)
+                elif ids == None or e[2] == None or e[2] in ids:
+                    result.append(f)
+            removed = len(self.files)-(len(stats)-len(stale)) > 0
+            if (len(stale) > 0 or removed) and not self.updating:
+                self.updating = True
+                async_search_pool.submit(self.update,(stale,set(names),))
+        finally:
+            self.lock.release()
+        return result
+
+    def lookup(self,literal):
+        # only trigrams inside words of literal are indexed, returns
+        # None if literal doesn't have any
+        trigrams = set()
+        for w in async_grep_index_word.findall(literal):
+            trigrams.update([w[i:i+3] for i in range(len(w)-2)])
+        if len(trigrams) == 0:
+            return None
+        ids = None
+        for t in sorted(trigrams, key=lambda t: len(self.postings.get(t,()))):
+            p = self.postings.get(t)
+            if p == None:
+                return set()
+            if ids == None:
+                ids = set(p)
             else:
-                pattern = re.compile(pattern[1:-1])
+                ids.intersection_update(p)
+            if len(ids) == 0:
+                break
+        return ids
+
+    def trigrams(self,rel):
+        # returns None if file can't be read and empty set for binary files,
+        # words are found by regular expression and only unique ones are split
+        try:
+            f = open(os.path.join(self.cwd,rel),'rb')
+        except (IOError, OSError):
+            return None
+        try:
+            data = f.read(async_grep_index_max_size)
+        except (IOError, OSError):
+            return None
+        finally:
+            f.close()
+        trigrams = set()
+        if b'\0' in data[:async_grep_sniff_size]:
+            return trigrams
+        for w in set(async_grep_index_word.findall(data.lower())):
+            trigrams.update([w[i:i+3] for i in range(len(w)-2)])
+        return trigrams
+
+    def update(self,stale,names):
+        try:
+            changes = self.change(stale,names)
+            # index is only changed by this thread until updating is reset,
+            # so it's saved without blocking searches
+            if changes == None or not self.append(changes):
+                self.save()
+        finally:
+            self.lock.acquire()
+            self.updating = False
+            self.lock.release()
+
+    def change(self,stale,names):
+        # returns changes that were made or None if index was compacted
+        changes = {'files': {}, 'postings': {}, 'removed': []}
+        for f, mtime, size in stale:
+            trigrams = None
+            if size <= async_grep_index_max_size:
+                trigrams = self.trigrams(f)
+                if trigrams == None:
+                    continue
+            self.lock.acquire()
+            old = self.files.get(f)
+            if old != None and old[2] != None and old[2] >= 0:
+                self.dead += 1
+            if trigrams == None:
+                i = None
+            elif len(trigrams) == 0:
+                i = -1
+            else:
+                i = self.next
+                self.next += 1
+                for t in trigrams:
+                    p = self.postings.get(t)
+                    if p == None:
+                        p = self.postings[t] = array.array('i')
+                    p.append(i)
+                    p = changes['postings'].get(t)
+                    if p == None:
+                        p = changes['postings'][t] = array.array('i')
+                    p.append(i)
+            self.files[f] = changes['files'][f] = (mtime,size,i)
+            self.lock.release()
+        self.lock.acquire()
+        try:
+            for f in list(self.files.keys()):
+                if not f in names:
+                    changes['removed'].append(f)
+                    i = self.files.pop(f)[2]
+                    if i != None and i >= 0:
+                        self.dead += 1
+            if self.dead > len(self.files):
+                self.compact()
+                return None
+            changes['next'] = self.next
+            changes['dead'] = self.dead
+            return changes
+        finally:
+            self.lock.release()
+
+    def compact(self):
+        live = set([e[2] for e in self.files.values()])
+        postings = {}
+        for t, p in self.postings.items():
+            p = array.array('i',[i for i in p if i in live])
+            if len(p) > 0:
+                postings[t] = p
+        self.postings = postings
+        self.dead = 0
+
+    def apply(self,changes):
+        # changes saved by other python version have trigrams as text
+        for t in changes['postings']:
+            if type(t) != bytes:
+                return False
+            break
+        self.files.update(changes['files'])
+        for f in changes['removed']:
+            self.files.pop(f,None)
+        for t, p in changes['postings'].items():
+            if t in self.postings:
+                self.postings[t].extend(p)
+            else:
+                self.postings[t] = p
+        self.next = changes['next']
+        self.dead = changes['dead']
+        return True
+
+    def load(self):
+        try:
+            f = open(self.path,'rb')
+            try:
+                index = pickle.loads(zlib.decompress(f.read()))
+            finally:
+                f.close()
+            # index saved by other python version has trigrams as text
+            for t in index['postings']:
+                if type(t) != bytes:
+                    return
+                break
+            if index['cwd'] != self.cwd:
+                return
+            self.files = index['files']
+            self.postings = index['postings']
+            self.next = index['next']
+            self.dead = index['dead']
+        except Exception:
+            return
+        # changes saved since are applied in order, incomplete last
+        # change is ignored
+        try:
+            f = open(self.log,'rb')
+            try:
+                while True:
+                    n = f.readline()
+                    if len(n) == 0:
+                        break
+                    data = f.read(int(n))
+                    if len(data) != int(n) or not self.apply(pickle.loads(zlib.decompress(data))):
+                        break
+            finally:
+                f.close()
+        except Exception:
+            pass
+
+    def append(self,changes):
+        # changes are appended to log while it's small compared to saved
+        # index, returns False if whole index has to be saved instead
+        try:
+            size = os.path.getsize(self.path)
+            if os.path.exists(self.log):
+                size -= 2*os.path.getsize(self.log)
+            data = zlib.compress(pickle.dumps(changes,2))
+            if size < 2*len(data):
+                return False
+            f = open(self.log,'ab')
+            try:
+                f.write(AsyncEncode(str(len(data)))+b'\n'+data)
+            finally:
+                f.close()
+            return True
+        except (IOError,OSError):
+            return False
+
+    def save(self):
+        try:
+            d = os.path.dirname(self.path)
+            if not os.path.isdir(d):
+                os.makedirs(d)
+            data = zlib.compress(pickle.dumps({'cwd': self.cwd, 'files': self.files, 'postings': self.postings, 'next': self.next, 'dead': self.dead},2))
+            # log is removed first so that it's never applied to newer index
+            if os.path.exists(self.log):
+                os.remove(self.log)
+            tmp = self.path+'.'+str(os.getpid())
+            f = open(tmp,'wb')
+            try:
+                f.write(data)
+            finally:
+                f.close()
+            if async_on_windows and os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(tmp,self.path)
+        except (IOError,OSError):
+            pass
+
+def AsyncGrepIndex(index_dir,ignore_dirs,ignore_files):
+    global async_grep_indexes
+    cwd = os.getcwd()
+    key = hashlib.sha1(AsyncEncode('\0'.join([cwd,ignore_dirs,ignore_files]))).hexdigest()
+    if not key in async_grep_indexes:
+        path = os.path.join(os.path.expanduser(index_dir),'trigrams-'+key)
+        async_grep_indexes[key] = AsyncTrigramIndex(cwd,path)
+    return async_grep_indexes[key]
+
+class AsyncGrepCache:
+    # least recently used results of searched files, limited in bytes
+    def __init__(self,limit):
+        self.limit = limit
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def sizeOf(self,lines):
+        return 100+sum([len(l)+50 for l in lines])
+
+    def get(self,key):
+        self.lock.acquire()
+        lines = self.entries.pop(key,None)
+        if lines != None:
+            self.entries[key] = lines
+        self.lock.release()
+        return lines
+
+    def put(self,key,lines):
+        size = self.sizeOf(lines)
+        if size > self.limit:
+            return
+        self.lock.acquire()
+        old = self.entries.pop(key,None)
+        if old != None:
+            self.size -= self.sizeOf(old)
+        self.entries[key] = lines
+        self.size += size
+        while self.size > self.limit:
+            k, l = self.entries.popitem(False)
+            self.size -= self.sizeOf(l)
+        self.lock.release()
+
+async_grep_cache = AsyncGrepCache(async_grep_cache_size)
+
+def AsyncGrepPattern(pattern,ignore_case):
+    # files are searched as bytes, returns regular expression and literal
+    # that every match contains, literal is searched first if present
+    if pattern.startswith('/') and pattern.endswith('/'):
+        flags = re.MULTILINE
+        if ignore_case:
+            flags |= re.IGNORECASE
+        try:
+            regex = AsyncEncode(pattern[1:-1])
+            if ignore_case:
+                regex = AsyncCaseless(regex,True)
+            regex = re.compile(regex,flags)
+            literal = None
+            if not regex.flags & re.IGNORECASE:
+                literal = AsyncRequiredLiteral(regex.pattern)
+            return regex, literal
         except:
             pass
-    if type(pattern) == str and ignore_case:
-        pattern = pattern.lower()
-    while not file_output.toExit():
-        files = file_output.get()
-        if len(files) == 0:
-            time.sleep(0.01)
+    pattern = AsyncEncode(pattern)
+    if ignore_case:
+        return re.compile(AsyncCaseless(pattern,False),re.IGNORECASE), None
+    return None, pattern
+
+def AsyncCaseless(pattern,regex):
+    # ignore case of bytes regular expression folds only ascii letters, every
+    # other character is replaced with alternatives of it's lower and upper
+    # case, characters inside of character sets are left as they are
+    text = pattern.decode('utf-8','replace')
+    r = []
+    i = 0
+    while i < len(text):
+        c = text[i]
+        i += 1
+        if regex and c == '\\':
+            r.append(text[i-1:i+1])
+            i += 1
+        elif regex and c == '[':
+            end = i
+            if end < len(text) and text[end] == '^':
+                end += 1
+            if end < len(text) and text[end] == ']':
+                end += 1
+            while end < len(text) and text[end] != ']':
+                if text[end] == '\\':
+                    end += 1
+                end += 1
+            r.append(text[i-1:end+1])
+            i = end+1
+        elif ord(c) < 128:
+            if regex:
+                r.append(c)
+            else:
+                r.append(re.escape(c))
         else:
-            for f in files:
-                lines = AsyncSearchInFile(f[2:],pattern,cwd,ignore_case)
-                if len(lines) > 0:
-                    output.extend(lines)
-    for f in file_output.get():
-        lines = AsyncSearchInFile(f[2:],pattern,cwd,ignore_case)
-        if len(lines) > 0:
-            output.extend(lines)
-    output.exit()
+            cases = []
+            for v in (c, c.lower(), c.upper(), c.title(), c.lower().upper(), c.upper().lower()):
+                if len(v) == 1 and not v in cases:
+                    cases.append(v)
+            if len(cases) == 1:
+                r.append(c)
+            else:
+                r.append('(?:'+'|'.join(cases)+')')
+    return ''.join(r).encode('utf-8')
 
-def AsyncSearchInFile(fn,pattern,cwd,ignore_case):
-    f = None
-    found = []
+def AsyncRequiredLiteral(pattern):
+    try:
+        literal = AsyncLiterals(sre_parse.parse(pattern))
+    except Exception:
+        return None
+    if len(literal) == 0:
+        return None
+    return literal
+
+def AsyncLiterals(seq):
+    # longest run of literals that is required by parsed regular expression
+    best = b''
+    run = []
+    for op, av in seq:
+        if op == sre_parse.LITERAL:
+            run.append(av)
+            continue
+        if op == sre_parse.AT:
+            continue
+        if len(run) > len(best):
+            best = bytes(bytearray(run))
+        run = []
+        sub = b''
+        if op == sre_parse.SUBPATTERN:
+            # group with scoped ignore case flag has no exact literals
+            if len(av) < 4 or not av[1] & re.IGNORECASE:
+                sub = AsyncLiterals(av[-1])
+        elif (op == sre_parse.MAX_REPEAT or op == sre_parse.MIN_REPEAT) and av[0] > 0:
+            sub = AsyncLiterals(av[2])
+        if len(sub) > len(best):
+            best = sub
+    if len(run) > len(best):
+        best = bytes(bytearray(run))
+    return best
+
+def AsyncGrepFiles(output,files,pattern,literal,key,cwd,results):
+    for f in files:
+        if output.toExit():
+            return
+        AsyncSearchInFile(output,f,pattern,literal,key,cwd,results)
+
+def AsyncSearchInFile(output,fn,pattern,literal,key,cwd,results):
+    # file is searched in big windows, lines are only found around matches,
+    # results are cached until file is modified and added to results
+    fn = os.path.join(cwd,fn)
+    try:
+        st = os.stat(fn)
+    except OSError:
+        return
+    key = (fn,st.st_mtime,st.st_size,key)
+    lines = async_grep_cache.get(key)
+    if lines != None:
+        output.extend(lines)
+        results.add(fn,lines,st)
+        return
+    try:
+        f = open(fn,'rb')
+    except (IOError, OSError):
+        return
+    data = None
+    mapped = None
+    lines = []
     try:
-        fn = os.path.abspath(cwd+os.sep+fn)
-        f = open(fn,'r')
-        if type(pattern) == str:
-            for i, line in enumerate(f):
-                if ignore_case:
-                    line = line.lower()
-                if pattern in line:
-                    found.append(fn+":"+str(i+1)+":"+line)
+        head = f.read(async_grep_sniff_size)
+        # skip binary files
+        if len(head) == 0 or b'\0' in head:
+            async_grep_cache.put(key,lines)
+            results.add(fn,lines,st)
+            return
+        if len(head) < async_grep_sniff_size:
+            data = head
         else:
-            for i, line in enumerate(f):
-                if len(re.findall(pattern, line)) > 0:
-                    found.append(fn+":"+str(i+1)+":"+line)
-        return found
-    except:
-        return found
+            mapped = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+            data = mapped
+        prefix = fn+":"
+        sent = 0
+        lnum = 1
+        # size of lines as counted by cache, None once they don't fit in it
+        cached = 100
+        size = len(data)
+        wstart = 0
+        while wstart < size:
+            # file is searched in windows that end at line end so that
+            # search can be stopped between them
+            if output.toExit():
+                return
+            wend = data.find(b'\n',wstart+async_grep_window_size)
+            if wend < 0:
+                wend = size
+            else:
+                wend += 1
+            buf = data[wstart:wend]
+            wstart = wend
+            # like in text mode line endings are normalized so matched
+            # lines don't end with \r and $ matches before \r\n
+            if buf.find(b'\r\n') >= 0:
+                buf = buf.replace(b'\r\n',b'\n')
+            counted = 0
+            pos = 0
+            bsize = len(buf)
+            while pos < bsize:
+                if literal != None:
+                    pos = buf.find(literal,pos)
+                    if pos < 0:
+                        break
+                    # regular expression is only run from line with literal
+                    if pattern != None:
+                        pos = buf.rfind(b'\n',0,pos)+1
+                if pattern != None:
+                    m = pattern.search(buf,pos)
+                    if m == None:
+                        break
+                    pos = m.start()
+                    # empty match after last newline isn't on any line
+                    if pos >= bsize and buf[bsize-1:bsize] == b'\n':
+                        break
+                start = buf.rfind(b'\n',0,pos)+1
+                end = buf.find(b'\n',pos)
+                if end < 0:
+                    end = bsize
+                # regular expression could have matched across lines
+                if pattern != None and pattern.search(buf,start,end) == None:
+                    pos = end+1
+                    continue
+                lnum += buf[counted:start].count(b'\n')
+                counted = start
+                line = prefix+str(lnum)+":"+AsyncDecode(buf[start:end])
+                lines.append(line)
+                if cached != None:
+                    cached += len(line)+50
+                    if cached > async_grep_cache.limit:
+                        cached = None
+                if len(lines)-sent >= 100:
+                    if output.toExit():
+                        return
+                    output.extend(lines[sent:])
+                    sent = len(lines)
+                    # only lines that aren't sent yet are kept for huge results
+                    if cached == None:
+                        lines = []
+                        sent = 0
+                pos = end+1
+            lnum += buf[counted:].count(b'\n')
+        output.extend(lines[sent:])
+        if cached == None:
+            results.add(fn,None,st)
+            return
+        async_grep_cache.put(key,lines)
+        results.add(fn,lines,st)
+    except (IOError, OSError, ValueError):
+        pass
     finally:
-        if f is not None:
-            f.close()
+        if mapped != None:
+            mapped.close()
+        f.close()
 
-def AsyncGrep(cmd,cwd):
+def AsyncGrep(cmd,cwd,rg=False):
     global async_grep_output
     output = async_grep_output
     if output.toExit():
         return
-    p = subprocess.Popen(cmd+" 2>&1", shell=True, cwd=cwd, preexec_fn=os.setsid, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    fcntl.fcntl(p.stdout.fileno(), fcntl.F_SETFL, os.O_NONBLOCK)
-    if 'poll' in dir(select):
-        pl = select.poll()
-        pl.register(p.stdout)
-    else:
-        pl = None
-    outread = ''
-    outrem = ''
-    while True:
-        try:
-            outread = ''
-            if pl != None:
-                plr = pl.poll(50)
-                if len(plr) == 0:
-                    outread = ''
-                else:
-                    plr = plr[0][1]
-                    try:
-                        if plr & select.POLLIN or plr & select.POLLPRI:
-                            outread = p.stdout.read()
-                        else:
-                            outread = ''
-                    except IOError:
-                        outread = ''
-            else:
-                try:
-                    outread = p.stdout.read()
-                except IOError:
-                    outread = ''
-            if len(outread) == 0:
-                retval = p.poll()
-                if retval != None:
-                    break
-                else:
-                    time.sleep(0.01)
+    p = subprocess.Popen(cmd+" 2>&1", shell=True, cwd=cwd, preexec_fn=os.setsid, stdout=subprocess.PIPE, bufsize=0)
+    # output is read in chunks as soon as it's available and split
+    # into lines, incomplete last line is kept until next chunk
+    fd = p.stdout.fileno()
+    stdout = io.open(fd,'rb',buffering=0,closefd=False)
+    sel = None
+    if selectors != None:
+        sel = selectors.DefaultSelector()
+        sel.register(fd,selectors.EVENT_READ)
+    buf = bytearray(65536)
+    rem = b''
+    try:
+        while not output.toExit():
+            if sel != None:
+                ready = sel.select(0.05)
             else:
-                outread = outread.decode('utf-8', 'ignore').split("\n")
-                if len(outrem) > 0:
-                    outread[0] = outrem+outread[0] 
-                if len(outread[-1]) > 0:
-                    outrem = outread[-1]
-                outread = outread[:-1]
-                output.extend(outread)
-            if output.toExit():
+                ready = select.select([fd],[],[],0.05)[0]
+            if len(ready) == 0:
+                continue
+            n = stdout.readinto(buf)
+            if not n:
                 break
-        except IOError:
-            time.sleep(0.01)
-    if len(outread) > 0:
-        if type(outread) == str:
-            outread = outread.split("\n")
-        if len(outread[-1]) == 0:
-            outread = outread[:-1]
-        output.extend(outread)
-    output.exit()
-    if pl != None:
-        pl.unregister(p.stdout)
-    try:
-        p.terminate()
-    except OSError:
-        pass
+            data = rem+bytes(buf[:n])
+            i = data.rfind(b'\n')
+            if i < 0:
+                rem = data
+                continue
+            rem = data[i+1:]
+            lines = AsyncDecode(data[:i]).split("\n")
+            if rg:
+                lines = AsyncGrepJson(lines)
+            output.extend(lines)
+        if len(rem) > 0 and not output.toExit():
+            lines = [AsyncDecode(rem)]
+            if rg:
+                lines = AsyncGrepJson(lines)
+            output.extend(lines)
+    finally:
+        output.exit()
+        if sel != None:
+            sel.close()
+        stdout.close()
+        p.stdout.close()
+        # grep is started in its own session so whole process group is killed
+        if p.poll() == None:
+            try:
+                os.killpg(p.pid,signal.SIGTERM)
+            except OSError:
+                pass
+        p.wait()
+
+
+def AsyncGrepJson(lines):
+    # turns rg --json match messages into grep like lines and keeps
+    # location of first match in each line for jumping to it
+    found = []
+    for l in lines:
+        if not l.startswith('{"type":"match"'):
+            continue
+        try:
+            data = json.loads(l)['data']
+            path = AsyncGrepJsonText(data['path'])
+            text = AsyncGrepJsonText(data['lines']).rstrip('\r\n')
+            lnum = data['line_number']
+            col = 1
+            if len(data['submatches']) > 0:
+                col = data['submatches'][0]['start']+1
+        except (ValueError, KeyError, TypeError):
+            continue
+        line = path+':'+str(lnum)+':'+text
+        if len(async_grep_locations) < async_grep_max_pending:
+            async_grep_locations[line] = (path,lnum,col)
+        found.append(line)
+    return found
+
+def AsyncGrepJsonText(data):
+    # rg encodes text that isn't valid utf-8 in base64
+    if 'text' in data:
+        return AsyncText(data['text'])
+    return AsyncDecode(base64.b64decode(data['bytes']))
 
+def AsyncGrepLocation():
+    loc = async_grep_locations.get(vim.current.line)
+    if loc == None:
+        return []
+    return list(loc)
 
 def AsyncGrepCancel():
-    global async_grep_pattern, async_grep_output, async_grep_file_output
+    global async_grep_pattern, async_grep_output, async_grep_results
     async_grep_pattern = None
+    async_grep_results = None
+    async_grep_locations.clear()
+    async_grep_scheduler.cancel()
     if async_grep_output != None:
         async_grep_output.exit()
         async_grep_output = None
-    if async_grep_file_output != None:
-        async_grep_file_output.exit()
-        async_grep_file_output = None
 
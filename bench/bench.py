@@ -0,0 +1,287 @@
+# Benchmarks for file search and builtin grep outside of vim
+#
+# vim module is replaced with a stub, synthetic directory trees are generated
+# and every engine, tree and pattern combination is run in it's own python
+# process so peak memory and thread count of each run are measured separately
+#
+#   python bench/bench.py                          run with current python
+#   python bench/bench.py --python python2         run with other python
+#   python bench/bench.py -o new.json --compare old.json
+#
+# Results are written as json, with --compare runs that are slower than
+# given threshold are reported and exit status is 1
+import sys, os, json, time, types, random, shutil, tempfile, threading, subprocess, optparse, platform, multiprocessing
+try:
+    import resource
+except ImportError:
+    resource = None
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ignore_dirs = "['.AppleDouble','.DS_Store','.git','.hg','.bzr']"
+ignore_files = "['*.swp']"
+words = ['alpha','beta','gamma','delta','epsilon','zeta','theta','kappa','lambda','sigma','omega','value','index','buffer','result','count']
+
+# pattern kind and pattern of each engine, every tree has files named
+# f<number>.txt in sub directories so all patterns except nomatch find some
+patterns = {
+    'find': [
+        ('glob','*'),
+        ('recursive','**/*.txt'),
+        ('substring','**/*1*'),
+        ('nomatch','**/*.zzz'),
+    ],
+    'grep': [
+        ('literal','needle'),
+        ('ignorecase','-i NEEDLE'),
+        ('regex','/need[a-z]+ [0-9]+/'),
+        ('regex_noliteral','/(needle|eldeen)[0-9 ]+/'),
+        ('nomatch','zzqqzz'),
+    ],
+}
+
+def text(rnd,lines):
+    r = []
+    for i in range(lines):
+        line = ' '.join([rnd.choice(words) for j in range(8)])
+        if rnd.random() < 0.01:
+            line += ' needle '+str(i)
+        r.append(line)
+    return '\n'.join(r)+'\n'
+
+def write(path,data):
+    d = os.path.dirname(path)
+    if not os.path.isdir(d):
+        os.makedirs(d)
+    f = open(path,'wb')
+    try:
+        if not isinstance(data,bytes):
+            data = data.encode('utf-8')
+        f.write(data)
+    finally:
+        f.close()
+
+def gen_deep(dir,rnd,scale):
+    for i in range(int(300*scale)):
+        depth = rnd.randint(8,20)
+        parts = ['d'+str(rnd.randint(0,2)) for j in range(depth)]
+        write(os.path.join(dir,os.path.join(*parts),'f'+str(i)+'.txt'),text(rnd,20))
+
+def gen_wide(dir,rnd,scale):
+    for i in range(int(2000*scale)):
+        for j in range(3):
+            write(os.path.join(dir,'w'+str(i),'f'+str(j)+'.txt'),text(rnd,10))
+
+def gen_small(dir,rnd,scale):
+    for i in range(int(50*scale)):
+        for j in range(100):
+            write(os.path.join(dir,'s'+str(i),'f'+str(j)+'.txt'),text(rnd,5))
+
+def gen_huge(dir,rnd,scale):
+    for i in range(4):
+        # about 16mb of text each
+        write(os.path.join(dir,'h','f'+str(i)+'.txt'),text(rnd,int(250000*scale)))
+
+def gen_binary(dir,rnd,scale):
+    for i in range(int(300*scale)):
+        data = bytearray(rnd.randint(0,255) for j in range(16384))
+        data[rnd.randint(0,100)] = 0
+        write(os.path.join(dir,'b'+str(i%10),'f'+str(i)+'.bin'),bytes(data))
+        if i % 10 == 0:
+            write(os.path.join(dir,'b'+str(i%10),'f'+str(i)+'.txt'),text(rnd,20))
+
+trees = [
+    ('deep',gen_deep),
+    ('wide',gen_wide),
+    ('small',gen_small),
+    ('huge',gen_huge),
+    ('binary',gen_binary),
+]
+
+def generate(dir,names,scale,seed):
+    # trees are generated only once for same scale and seed
+    info = {}
+    for name, gen in trees:
+        if not name in names:
+            continue
+        path = os.path.join(dir,name)
+        stamp = os.path.join(path,'.bench')
+        params = json.dumps({'scale': scale, 'seed': seed, 'layout': 2})
+        if not os.path.exists(stamp) or open(stamp).read() != params:
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            gen(path,random.Random(seed),scale)
+            write(stamp,params)
+        files = 0
+        size = 0
+        for r, ds, fs in os.walk(path):
+            for f in fs:
+                files += 1
+                size += os.path.getsize(os.path.join(r,f))
+        info[name] = {'path': path, 'files': files, 'bytes': size}
+    return info
+
+def stub_vim():
+    vim = types.ModuleType('vim')
+    vim.vars = {}
+    vim.eval = lambda e: vim.vars.get(e,'')
+    vim.command = lambda c: None
+    vim.current = types.ModuleType('vim.current')
+    vim.current.buffer = []
+    sys.modules['vim'] = vim
+    return vim
+
+def load():
+    stub_vim()
+    if sys.version_info[0] >= 3:
+        sys.path.insert(0,os.path.join(root,'autoload','py3'))
+    else:
+        sys.path.insert(0,os.path.join(root,'autoload','py2'))
+    import asyncfinder
+    return asyncfinder
+
+def peak_rss():
+    # kilobytes on linux, bytes on mac
+    if resource == None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss = rss//1024
+    return rss
+
+def run(engine,dir,pattern):
+    af = load()
+    os.chdir(dir)
+    if engine == 'find':
+        output = af.AsyncOutput()
+        search = af.AsyncSearch
+        args = (output,'f',pattern,[],'',False,False,ignore_dirs,ignore_files,)
+    else:
+        options = ''
+        if pattern.startswith('-i '):
+            options = ' -i'
+            pattern = pattern[3:]
+        output = af.AsyncBoundedOutput(af.async_grep_max_pending)
+        af.async_grep_output = output
+        search = af.AsyncGrepBuiltin
+        args = ('builtin'+options+ignore_files+ignore_dirs+" '"+pattern.replace("'","\\'")+"' "+dir,dir,)
+    threads = threading.active_count()
+    start = time.time()
+    t = threading.Thread(target=search,args=args)
+    t.daemon = True
+    t.start()
+    first = None
+    lines = 0
+    while True:
+        done = output.toExit()
+        r = output.get()
+        if len(r) > 0:
+            if first == None:
+                first = time.time()-start
+            lines += len(r)
+        elif done:
+            break
+        else:
+            time.sleep(0.001)
+        threads = max(threads,threading.active_count())
+    total = time.time()-start
+    t.join()
+    return {'first': first, 'total': total, 'lines': lines, 'peak_rss_kb': peak_rss(), 'threads': threads}
+
+def bench(python,engine,tree,pattern,repeat):
+    # each run is done in separate process with cold grep cache
+    result = None
+    for i in range(repeat):
+        p = subprocess.Popen([python,os.path.abspath(__file__),'--run',json.dumps([engine,tree,pattern])], stdout=subprocess.PIPE)
+        out = p.communicate()[0]
+        if p.returncode != 0:
+            raise RuntimeError('benchmark run failed: '+' '.join([python,engine,tree,pattern]))
+        r = json.loads(out.decode('utf-8'))
+        if result == None or r['total'] < result['total']:
+            result = r
+    return result
+
+def compare(results,baseline,threshold):
+    old = {}
+    for r in baseline['results']:
+        old[(r['python'],r['engine'],r['tree'],r['kind'])] = r
+    regressions = []
+    for r in results:
+        o = old.get((r['python'],r['engine'],r['tree'],r['kind']))
+        # very short runs are too noisy to compare
+        if o == None or o['total'] < 0.01:
+            continue
+        if r['total'] > o['total']*(1+threshold):
+            regressions.append((r,o))
+    return regressions
+
+def version(python):
+    p = subprocess.Popen([python,'-c','import platform; print(platform.python_version())'], stdout=subprocess.PIPE)
+    return p.communicate()[0].decode('utf-8').strip()
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--dir', help='directory where trees are generated, temporary directory by default')
+    parser.add_option('--trees', default=','.join([t[0] for t in trees]), help='comma separated trees to generate')
+    parser.add_option('--engines', default='find,grep', help='comma separated engines to run')
+    parser.add_option('--scale', type='float', default=1.0, help='size of generated trees')
+    parser.add_option('--seed', type='int', default=1)
+    parser.add_option('--repeat', type='int', default=3, help='runs of each benchmark, fastest is reported')
+    parser.add_option('--python', action='append', help='python interpreter to run with, can be given more than once')
+    parser.add_option('-o', '--output', help='json file where results are written, stdout by default')
+    parser.add_option('--compare', help='json file with previous results')
+    parser.add_option('--threshold', type='float', default=0.2, help='slowdown reported as regression')
+    parser.add_option('--run', help=optparse.SUPPRESS_HELP)
+    (opts, args) = parser.parse_args()
+    if opts.run != None:
+        (engine,dir,pattern) = json.loads(opts.run)
+        sys.stdout.write(json.dumps(run(engine,dir,pattern)))
+        sys.stdout.flush()
+        # pool threads of plugin are still running, python2 reports
+        # errors in them on normal interpreter shutdown
+        os._exit(0)
+    dir = opts.dir
+    if dir == None:
+        dir = tempfile.mkdtemp(prefix='asyncfinder-bench-')
+    pythons = opts.python or [sys.executable]
+    try:
+        info = generate(os.path.abspath(dir),opts.trees.split(','),opts.scale,opts.seed)
+        results = []
+        for python in pythons:
+            for engine in opts.engines.split(','):
+                for tree in sorted(info):
+                    for kind, pattern in patterns[engine]:
+                        r = bench(python,engine,info[tree]['path'],pattern,opts.repeat)
+                        r.update({'python': version(python), 'engine': engine, 'tree': tree, 'kind': kind, 'pattern': pattern})
+                        results.append(r)
+                        sys.stderr.write('%s %s %s %s: %.3fs first %s, %d lines\n' % (r['python'],engine,tree,kind,r['total'],r['first'] != None and '%.3fs' % r['first'] or '-',r['lines']))
+    finally:
+        if opts.dir == None:
+            shutil.rmtree(dir)
+    data = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'platform': platform.platform(),
+        'cpus': multiprocessing.cpu_count(),
+        'scale': opts.scale,
+        'seed': opts.seed,
+        'trees': dict([(t, {'files': info[t]['files'], 'bytes': info[t]['bytes']}) for t in info]),
+        'results': results,
+    }
+    out = json.dumps(data,indent=2,sort_keys=True)
+    if opts.output != None:
+        write(opts.output,out+'\n')
+    else:
+        sys.stdout.write(out+'\n')
+    status = 0
+    if opts.compare != None:
+        f = open(opts.compare)
+        try:
+            baseline = json.load(f)
+        finally:
+            f.close()
+        for r, o in compare(results,baseline,opts.threshold):
+            sys.stderr.write('regression %s %s %s %s: %.3fs -> %.3fs\n' % (r['python'],r['engine'],r['tree'],r['kind'],o['total'],r['total']))
+            status = 1
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
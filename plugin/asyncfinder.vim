@@ -43,6 +43,14 @@ if !exists("g:asyncfinder_match_camel_case")
     let g:asyncfinder_match_camel_case = 0
 endif
 
+if !exists("g:asyncfinder_match_fuzzy")
+    let g:asyncfinder_match_fuzzy = 0
+endif
+
+if !exists("g:asyncfinder_match_fuzzy_limit")
+    let g:asyncfinder_match_fuzzy_limit = 100
+endif
+
 if !exists("g:asyncfinder_include_buffers")
     let g:asyncfinder_include_buffers = 1
 endif
@@ -59,6 +67,42 @@ if !exists("g:asyncfinder_speed_mode")
     let g:asyncfinder_speed_mode = 1
 endif 
 
+if !exists("g:asyncfinder_speed_mode_timeout")
+    let g:asyncfinder_speed_mode_timeout = 30
+endif
+
+if !exists("g:asyncfinder_refresh_interval")
+    let g:asyncfinder_refresh_interval = 50
+endif
+
+if !exists("g:asyncfinder_debounce")
+    let g:asyncfinder_debounce = 100
+endif
+
+if !exists("g:asyncfinder_max_lines")
+    let g:asyncfinder_max_lines = 10000
+endif
+
+if !exists("g:asyncfinder_refresh_lines")
+    let g:asyncfinder_refresh_lines = 1000
+endif
+
+if !exists("g:asyncfinder_use_index")
+    let g:asyncfinder_use_index = 0
+endif
+
+if !exists("g:asyncfinder_use_git")
+    let g:asyncfinder_use_git = 0
+endif
+
+if !exists("g:asyncfinder_index_dir")
+    let g:asyncfinder_index_dir = "~/.cache/asyncfinder"
+endif
+
+if !exists("g:asyncfinder_match_processes")
+    let g:asyncfinder_match_processes = 0
+endif
+
 if !exists("g:asyncfinder_grep_open_in_prev_win")
     let g:asyncfinder_grep_open_in_prev_win = 0 
 endif
@@ -82,6 +126,14 @@ endif
 if !exists("g:asyncfinder_grep_ignore_files")
     let g:asyncfinder_grep_ignore_files = "['*.swp']"
 endif
+
+if !exists("g:asyncfinder_grep_use_index")
+    let g:asyncfinder_grep_use_index = 0
+endif
+
+if !exists("g:asyncfinder_grep_use_git")
+    let g:asyncfinder_grep_use_git = 0
+endif
 " }}}
 
 " commands {{{1